@@ -1,150 +1,467 @@
 #!/usr/bin/env python
 import asyncio
-import atexit
 import logging
 import os
+import tempfile
 import time
-from datetime import datetime
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from functools import lru_cache
 
+from aiobotocore.config import AioConfig
 from aiobotocore.session import get_session
 from dotenv import load_dotenv
 
-# set the working directory to the script's directory
-os.chdir(os.path.dirname(os.path.realpath(__file__)))
+logger = logging.getLogger(__name__)
 
-load_dotenv(dotenv_path=".env")
+# lets each read of the compressed dump return large chunks instead of the
+# default 64 KiB, cutting the number of reads on multi-gigabyte dumps
+PIPE_BUFFER_SIZE = 4 * 1024 * 1024
 
-LOG_LEVEL = os.getenv("LOG_LEVEL")
-DB_USER = os.getenv("DB_USER")
-DB_PASS = os.getenv("DB_PASS")
-DB_NAME = os.getenv("DB_NAME")
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
-AWS_BUCKET_REGION = os.getenv("AWS_BUCKET_REGION")
-AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
 
-assert LOG_LEVEL is not None
-assert DB_USER is not None
-assert DB_PASS is not None
-assert DB_NAME is not None
-assert AWS_ACCESS_KEY_ID is not None
-assert AWS_SECRET_ACCESS_KEY is not None
-assert AWS_BUCKET_NAME is not None
-assert AWS_BUCKET_REGION is not None
-assert AWS_ENDPOINT_URL is not None
+@dataclass(frozen=True, slots=True)
+class Config:
+    log_level: str
+    db_user: str
+    db_pass: str
+    db_name: str
+    aws_access_key_id: str
+    aws_secret_access_key: str
+    aws_bucket_name: str
+    aws_bucket_region: str
+    aws_endpoint_url: str
+    s3_upload_concurrency: int
+    # mysqldump output is buffered up to this size before being sent as one
+    # part, so peak memory usage is bounded by roughly
+    # s3_part_size * s3_upload_concurrency
+    s3_part_size: int
 
 
-def magnitude_format_size(size: float) -> str:
-    for unit in ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"]:
-        if size < 1024.0:
-            return f"{size:3.1f} {unit}"
-        size /= 1024.0
-    raise NotImplementedError("Size too large")
+# each of these is stored on the Config field of the same name, lowercased
+_REQUIRED_ENV_VARS = (
+    "LOG_LEVEL",
+    "DB_USER",
+    "DB_PASS",
+    "DB_NAME",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_BUCKET_NAME",
+    "AWS_BUCKET_REGION",
+    "AWS_ENDPOINT_URL",
+)
+
+
+@lru_cache(maxsize=1)
+def _load_config() -> Config:
+    # the .env file lives next to the script, not in the working directory
+    load_dotenv(
+        dotenv_path=os.path.join(os.path.dirname(os.path.realpath(__file__)), ".env"),
+    )
+
+    missing = [name for name in _REQUIRED_ENV_VARS if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(
+            f"missing required environment variables: {', '.join(missing)}",
+        )
+
+    s3_upload_concurrency = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+    if s3_upload_concurrency <= 0:
+        raise ValueError("S3_UPLOAD_CONCURRENCY must be greater than 0")
+
+    s3_part_size = int(os.getenv("S3_PART_SIZE_MB", "50")) * 1024 * 1024
+    if s3_part_size < 5 * 1024 * 1024:
+        raise ValueError("S3_PART_SIZE_MB must be at least the s3 minimum of 5")
+
+    return Config(
+        **{name.lower(): os.environ[name] for name in _REQUIRED_ENV_VARS},
+        s3_upload_concurrency=s3_upload_concurrency,
+        s3_part_size=s3_part_size,
+    )
+
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
+# (upper bound in seconds, seconds per unit, unit)
+_TIME_UNITS = (
+    (60.0, 1.0, "s"),
+    (60.0 * 60.0, 60.0, "m"),
+    (60.0 * 60.0 * 60.0, 60.0 * 60.0, "h"),
+)
+
+
+def magnitude_format_size(size: int) -> str:
+    # every unit is 2**10 times the previous one, so the bit length picks it
+    magnitude = (size.bit_length() - 1) // 10 if size > 0 else 0
+    if magnitude >= len(_SIZE_UNITS):
+        raise NotImplementedError("Size too large")
+    return f"{size / (1 << (10 * magnitude)):3.1f} {_SIZE_UNITS[magnitude]}"
 
 
 def magnitude_time_format(seconds: float) -> str:
-    for unit in ["s", "m", "h"]:
-        if seconds < 60.0:
-            return f"{seconds:.2f}{unit}"
-        seconds /= 60.0
+    for limit, scale, unit in _TIME_UNITS:
+        if seconds < limit:
+            return f"{seconds / scale:.2f}{unit}"
     raise NotImplementedError("Time too large")
 
 
-async def export_sql_to_file(
-    file_name: str,
-    db_user: str,
-    db_pass: str,
+def write_mysql_defaults_file(db_user: str, db_pass: str) -> str:
+    # credentials go through a 0600 option file so they never show up in the
+    # command line of sudo or mysqldump
+    fd, path = tempfile.mkstemp(prefix="sql-backup-", suffix=".cnf")
+    try:
+        with os.fdopen(fd, "w") as defaults_file:
+            defaults_file.write("[client]\n")
+            for option, value in (("user", db_user), ("password", db_pass)):
+                # quoting keeps whitespace and '#' intact, and mysql still
+                # unescapes backslash sequences inside the quotes
+                value = (
+                    value.replace("\\", "\\\\")
+                    .replace("\n", "\\n")
+                    .replace("\r", "\\r")
+                )
+                defaults_file.write(f'{option}="{value}"\n')
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path
+
+
+async def start_sql_export(
+    defaults_file: str,
     db_name: str,
-) -> int:
-    with open(file_name, "wb+") as backup_file:
-        process = await asyncio.subprocess.create_subprocess_shell(
-        f"sudo mysqldump -u {db_user} -p{db_pass} {db_name}",
-        stdout=backup_file,
-        stderr=asyncio.subprocess.PIPE,
-    )
-        # make sure all data is flushed
-        _, stderr = await process.communicate()
+) -> tuple[asyncio.subprocess.Process, asyncio.subprocess.Process]:
+    # mysqldump writes straight into zstd through an os-level pipe, so the
+    # two run in parallel and only the compressed dump passes through python
+    read_fd, write_fd = os.pipe()
 
-    if process.stderr is not None:
-        logging.error(stderr.decode())
+    try:
+        dump_process = await asyncio.subprocess.create_subprocess_exec(
+            "sudo",
+            "mysqldump",
+            # must be the first option for mysqldump to accept it
+            f"--defaults-extra-file={defaults_file}",
+            db_name,
+            stdout=write_fd,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
 
-    if process.returncode is None:
-        return 1
+    try:
+        compress_process = await asyncio.subprocess.create_subprocess_exec(
+            "zstd",
+            "-T0",
+            "-3",
+            "-q",
+            "-c",
+            stdin=read_fd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=PIPE_BUFFER_SIZE,
+        )
+    except BaseException:
+        # nothing will ever read the dump, so it must not be left writing
+        os.close(read_fd)
+        await stop_sql_export(dump_process)
+        raise
 
-    return process.returncode
+    os.close(read_fd)
 
+    return dump_process, compress_process
 
-async def upload_file_to_s3(
-    file_name: str,
-    region_name: str,
-    endpoint_url: str,
-    aws_access_key_id: str,
-    aws_secret_access_key: str,
-    bucket_name: str,
+
+async def stop_sql_export(
+    dump_process: asyncio.subprocess.Process,
+    compress_process: asyncio.subprocess.Process | None = None,
 ) -> None:
-    session = get_session()  # TODO: env vars?
-    with open(file_name, "rb") as backup_file:
-        async with session.create_client(
-            service_name="s3",
-            region_name=region_name,
-            endpoint_url=endpoint_url,
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-        ) as s3_client:
-            await s3_client.put_object(
+    # zstd goes first so mysqldump gets EPIPE rather than blocking on a full
+    # pipe. sudo can't relay SIGKILL to mysqldump, but it does relay SIGTERM
+    if compress_process is not None and compress_process.returncode is None:
+        compress_process.kill()
+        await compress_process.wait()
+
+    if dump_process.returncode is None:
+        dump_process.terminate()
+        await dump_process.wait()
+
+
+async def drain_stderr(stream: asyncio.StreamReader) -> None:
+    async for line in stream:
+        logger.warning("%s", line.decode(errors="replace").rstrip())
+
+
+async def upload_parts(
+    stream: asyncio.StreamReader,
+    s3_client,
+    bucket_name: str,
+    object_key: str,
+    upload_id: str,
+    concurrency: int,
+    part_size: int,
+) -> tuple[list[dict[str, str | int]], int]:
+    inflight = asyncio.Semaphore(concurrency)
+    tasks: list[asyncio.Task[dict[str, str | int]]] = []
+    buffer = bytearray()
+    bytes_uploaded = 0
+
+    async def upload_one(
+        part_number: int,
+        body: bytearray,
+    ) -> dict[str, str | int]:
+        try:
+            response = await s3_client.upload_part(
                 Bucket=bucket_name,
-                Key=f"db-backups/{file_name}",
-                Body=backup_file,
+                Key=object_key,
+                PartNumber=part_number,
+                UploadId=upload_id,
+                Body=body,
+                # botocore hashes the body once while sending it and passes
+                # the digest as a trailer for s3 to verify the part against
+                ChecksumAlgorithm="SHA256",
+            )
+        finally:
+            inflight.release()
+
+        part: dict[str, str | int] = {
+            "PartNumber": part_number,
+            "ETag": response["ETag"],
+        }
+        # s3-compatible services don't always echo the checksum back
+        if (checksum := response.get("ChecksumSHA256")) is not None:
+            part["ChecksumSHA256"] = checksum
+
+        return part
+
+    async def flush() -> None:
+        nonlocal buffer, bytes_uploaded
+        await inflight.acquire()
+
+        # stop reading the dump as soon as any part has failed
+        for task in tasks:
+            if task.done() and (error := task.exception()) is not None:
+                inflight.release()
+                raise error
+
+        part_number = len(tasks) + 1
+        bytes_uploaded += len(buffer)
+        # hand the filled buffer over as-is rather than copying it, so each
+        # in-flight part is only held in memory once
+        tasks.append(asyncio.create_task(upload_one(part_number, buffer)))
+        buffer = bytearray()
+
+    try:
+        while chunk := await stream.read(part_size - len(buffer)):
+            buffer += chunk
+            if len(buffer) >= part_size:
+                await flush()
+
+        # the last part is allowed to be smaller than the s3 minimum
+        if buffer or not tasks:
+            await flush()
+
+        # gather keeps submission order, so parts are already sorted
+        return list(await asyncio.gather(*tasks)), bytes_uploaded
+    except BaseException:
+        # every request must have settled before the caller aborts the upload,
+        # or a late part could land after the abort
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# holds one s3 client open across backups, so a long-running process can call
+# backup_once repeatedly without paying for a new session and tls handshake
+class S3Backup:
+    def __init__(
+        self,
+        region_name: str,
+        endpoint_url: str,
+        aws_access_key_id: str,
+        aws_secret_access_key: str,
+        bucket_name: str,
+        concurrency: int,
+        part_size: int,
+    ) -> None:
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.bucket_name = bucket_name
+        self.concurrency = concurrency
+        self.part_size = part_size
+
+        self._session = get_session()  # TODO: env vars?
+        self._exit_stack = AsyncExitStack()
+        self._client = None
+
+    async def initialize(self) -> None:
+        self._client = await self._exit_stack.enter_async_context(
+            self._session.create_client(
+                service_name="s3",
+                region_name=self.region_name,
+                endpoint_url=self.endpoint_url,
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                config=AioConfig(
+                    # keep enough pooled connections for every in-flight part
+                    max_pool_connections=max(self.concurrency, 50),
+                    signature_version="s3v4",
+                    # idle connections survive between parts and between
+                    # backups, so they ride one tls session instead of many
+                    connector_args={"keepalive_timeout": 300},
+                ),
+            ),
+        )
+
+    async def dispose(self) -> None:
+        await self._exit_stack.aclose()
+        self._client = None
+
+    async def _abort_upload(self, object_key: str, upload_id: str) -> None:
+        assert self._client is not None
+
+        # a failed abort is only logged, so it never hides the original error
+        try:
+            await self._client.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=object_key,
+                UploadId=upload_id,
+            )
+        except Exception:
+            logger.exception("failed to abort multipart upload %s", upload_id)
+
+    async def backup_once(
+        self,
+        object_key: str,
+        db_user: str,
+        db_pass: str,
+        db_name: str,
+    ) -> tuple[int, int]:
+        s3_client = self._client
+        if s3_client is None:
+            raise RuntimeError("initialize() must be awaited first")
+
+        multipart_upload = await s3_client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=object_key,
+            ChecksumAlgorithm="SHA256",
+        )
+        upload_id = multipart_upload["UploadId"]
+
+        defaults_file: str | None = None
+        processes: tuple[asyncio.subprocess.Process, ...] = ()
+        stderr_tasks: list[asyncio.Task[None]] = []
+
+        try:
+            defaults_file = write_mysql_defaults_file(db_user, db_pass)
+            dump_process, compress_process = await start_sql_export(
+                defaults_file=defaults_file,
+                db_name=db_name,
+            )
+            processes = (dump_process, compress_process)
+            assert compress_process.stdout is not None
+
+            # stderr is drained alongside the upload so a chatty process can
+            # never stall on a full stderr pipe while stdout is being consumed
+            for process in processes:
+                assert process.stderr is not None
+                stderr_tasks.append(
+                    asyncio.create_task(drain_stderr(process.stderr)),
+                )
+
+            parts, bytes_uploaded = await upload_parts(
+                stream=compress_process.stdout,
+                s3_client=s3_client,
+                bucket_name=self.bucket_name,
+                object_key=object_key,
+                upload_id=upload_id,
+                concurrency=self.concurrency,
+                part_size=self.part_size,
+            )
+
+            # a partial dump should never be committed to the bucket
+            exit_codes = [await process.wait() for process in processes]
+            await asyncio.gather(*stderr_tasks)
+
+            export_exit_code = next((code for code in exit_codes if code != 0), 0)
+            if export_exit_code != 0:
+                await self._abort_upload(object_key, upload_id)
+                return export_exit_code, bytes_uploaded
+
+            await s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=object_key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
             )
+        except BaseException:
+            if processes:
+                await stop_sql_export(*processes)
+
+            for task in stderr_tasks:
+                task.cancel()
+            await asyncio.gather(*stderr_tasks, return_exceptions=True)
 
+            await self._abort_upload(object_key, upload_id)
+            raise
+        finally:
+            if defaults_file is not None:
+                os.remove(defaults_file)
 
-def remove_if_exists(file_name: str) -> None:
-    if os.path.exists(file_name):
-        os.remove(file_name)
+        return 0, bytes_uploaded
 
 
 async def main() -> int:
+    cfg = _load_config()
     start_time = time.perf_counter()
-    backup_file_name = f"backup_{datetime.now().isoformat()}.sql"
-
-    # make sure the backup is removed from disk
-    atexit.register(remove_if_exists, backup_file_name)
+    backup_file_name = time.strftime("backup_%Y%m%dT%H%M%SZ.sql.zst", time.gmtime())
 
-    export_exit_code = await export_sql_to_file(
-        db_user=DB_USER,
-        db_pass=DB_PASS,
-        db_name=DB_NAME,
-        file_name=backup_file_name,
+    s3_backup = S3Backup(
+        region_name=cfg.aws_bucket_region,
+        endpoint_url=cfg.aws_endpoint_url,
+        aws_access_key_id=cfg.aws_access_key_id,
+        aws_secret_access_key=cfg.aws_secret_access_key,
+        bucket_name=cfg.aws_bucket_name,
+        concurrency=cfg.s3_upload_concurrency,
+        part_size=cfg.s3_part_size,
     )
 
-    if export_exit_code != 0:
-        return export_exit_code
-
     try:
-        await upload_file_to_s3(
-            file_name=backup_file_name,
-            region_name=AWS_BUCKET_REGION,
-            endpoint_url=AWS_ENDPOINT_URL,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            bucket_name=AWS_BUCKET_NAME,
+        await s3_backup.initialize()
+        export_exit_code, bytes_uploaded = await s3_backup.backup_once(
+            object_key=f"db-backups/{backup_file_name}",
+            db_user=cfg.db_user,
+            db_pass=cfg.db_pass,
+            db_name=cfg.db_name,
         )
     except Exception as e:
-        logging.error(f"{backup_file_name} failed uploading to bucket")
-        logging.error(e)
+        logger.error("%s failed uploading to bucket", backup_file_name)
+        logger.error("%s", e)
         return 1
+    finally:
+        await s3_backup.dispose()
 
-    # get file stats for backup file on disk
-    stat_result = os.stat(backup_file_name)
+    if export_exit_code != 0:
+        logger.error("%s: dump exited with %d", backup_file_name, export_exit_code)
+        return export_exit_code
 
-    file_size = magnitude_format_size(stat_result.st_size)
-    time_elapsed = magnitude_time_format(time.perf_counter() - start_time)
-    logging.info(f"{backup_file_name} ({file_size}) uploaded in {time_elapsed}")
+    # only pay for the size and time formatting when the line will be emitted
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "%s (%s) uploaded in %s",
+            backup_file_name,
+            magnitude_format_size(bytes_uploaded),
+            magnitude_time_format(time.perf_counter() - start_time),
+        )
 
     return 0
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=LOG_LEVEL)
+    logging.basicConfig(level=_load_config().log_level)
     raise SystemExit(asyncio.run(main()))